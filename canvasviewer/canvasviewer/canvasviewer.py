@@ -1,8 +1,26 @@
+from functools import partial
 from krita import DockWidget, DockWidgetFactory, DockWidgetFactoryBase, Krita
 from PyQt5.QtWidgets import QWidget, QVBoxLayout, QLabel, QDesktopWidget, QApplication
-from PyQt5.QtCore import Qt, QObject, QThread, QTimer, pyqtSignal
+from PyQt5.QtCore import Qt, QObject, QEvent, QThread, QTimer, pyqtSignal, pyqtSlot
 from PyQt5.QtGui import QImage, QPixmap, QPalette
 
+# OpenCV为可选依赖，未安装时回退到Qt缩放
+try:
+    import numpy as np
+    import cv2
+except ImportError:
+    cv2 = None
+
+# PIL为可选依赖，未安装OpenCV时使用
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# 线程间传递的像素数据统一使用预乘ARGB32格式，这是Qt缩放和QPixmap转换的原生格式，
+# 可避免scaled()和fromImage()内部的额外格式转换（同时保留透明度）
+PIXEL_FORMAT = QImage.Format_ARGB32_Premultiplied
+
 class Config:
     # 面板基本设置
     docker_id = 'pykrita_canvasviewer'
@@ -19,13 +37,15 @@ class Config:
     
     # 缩略图配置
     thumbnail_min_size = 140  # 缩略图最小尺寸
-    thumbnail_upscale_factor = 2  # 缩略图放大倍数（用于两步缩放）
-    use_hybrid_scaling = True  # 是否使用混合缩放（False则使用直接SmoothTransformation缩放）
+    thumbnail_upscale_factor = 2  # 缩略图放大倍数（向Krita请求的缩略图相对目标尺寸的倍数，以及放大时的两步缩放）
+    use_hybrid_scaling = True  # 放大时是否使用混合缩放（False则使用直接SmoothTransformation缩放）
     
     # 定时器配置（毫秒）
-    state_check_interval = 100  # 状态检查间隔
+    release_check_interval = 500  # 按住期间检查是否漏掉了释放事件的间隔
     idle_check_interval = 300  # 空闲检查间隔
     idle_refresh_interval = 400  # 空闲刷新间隔
+    idle_refresh_max_interval = 3200  # 画布无变化时空闲刷新间隔逐次加倍的上限
+    refresh_debounce_interval = 30  # 刷新请求合并间隔
     
     # 面板位置
     dock_position = DockWidgetFactoryBase.DockRight
@@ -50,72 +70,121 @@ class Config:
 
 
 class Worker(QObject):
-    finished = pyqtSignal(QImage)
-    
-    def __init__(self, projection, width, height):
-        super().__init__()
-        self.projection = projection
-        self.width = width
-        self.height = height
+    # 常驻在后台线程中，不保存任何任务状态，每次任务的数据都通过do_job传入。
+    # 线程间只传递原始像素字节，不共享QImage，所有QPixmap操作都留在GUI线程
+    finished = pyqtSignal(bytes, int, int, int)
     
-    def process(self):
+    @pyqtSlot(bytes, int, int, int, int, int, bool)
+    def do_job(self, data, src_width, src_height, bytes_per_line, physical_width, physical_height, by_width):
         try:
-            # 物理像素尺寸 = 逻辑尺寸 * DPI 缩放因子
-            dpi_scale = self.projection.devicePixelRatio()
-            physical_width = int(self.width * dpi_scale)
-            physical_height = int(self.height * dpi_scale)
-
-            # 预处理（抗锯齿）
-            smoothed = self.projection.scaled(
-                self.projection.width() * 2, 
-                self.projection.height() * 2,
-                Qt.KeepAspectRatio, 
-                Qt.SmoothTransformation
-            )
-
-            # 第一步：FastTransformation 缩放到两倍目标物理尺寸
-            double_width = physical_width * Config.thumbnail_upscale_factor
-            double_height = physical_height * Config.thumbnail_upscale_factor
-            fast_scaled = smoothed.scaled(
-                double_width, double_height,
-                Qt.KeepAspectRatio, 
-                Qt.FastTransformation
-            )
-
-            # 第二步：SmoothTransformation 缩放到目标物理尺寸
-            final_scaled = fast_scaled.scaled(
-                physical_width, physical_height,
-                Qt.KeepAspectRatio, 
-                Qt.SmoothTransformation
-            )
+            # 以get_thumbnail_size选定的边为基准缩放，另一边按宽高比推算
+            length = physical_width if by_width else physical_height
 
-            # 设置物理像素信息
-            final_scaled.setDevicePixelRatio(dpi_scale)
-            self.finished.emit(final_scaled)
+            if Config.use_hybrid_scaling and src_width < physical_width:
+                # 画布小于目标尺寸（真正的放大）：先FastTransformation放大到目标的数倍，
+                # 再SmoothTransformation缩小到目标尺寸，兼顾速度与抗锯齿
+                result = self.scale_hybrid(data, src_width, src_height, bytes_per_line,
+                                           length, by_width)
+            elif cv2 is not None or Image is not None:
+                if by_width:
+                    width = length
+                    height = max(1, round(src_height * length / src_width))
+                else:
+                    width = max(1, round(src_width * length / src_height))
+                    height = length
+                if cv2 is not None:
+                    # 画布大于目标尺寸（常见情况）：优先使用OpenCV的区域插值缩小，速度更快且抗锯齿更好
+                    result = self.resize_area(data, src_width, src_height, bytes_per_line, width, height)
+                else:
+                    # 其次使用PIL的Lanczos重采样
+                    result = self.resize_lanczos(data, src_width, src_height, bytes_per_line, width, height)
+            else:
+                # 都没有时一次SmoothTransformation直接缩放到目标物理尺寸
+                result = self.scale_smooth(data, src_width, src_height, bytes_per_line,
+                                           length, by_width)
+
+            # 32位格式每行没有填充字节
+            pixels, width, height = result
+            self.finished.emit(pixels, width, height, 4 * width)
         except Exception as e:
             print(f"Worker error: {str(e)}")
-            self.finished.emit(QImage())
+            self.finished.emit(b'', 0, 0, 0)
+
+    @staticmethod
+    def image_to_bytes(image):
+        # 32位格式每行没有填充字节，整块拷贝即为紧凑的像素数据
+        return image.constBits().asstring(image.sizeInBytes()), image.width(), image.height()
+
+    @staticmethod
+    def scale_to(image, length, by_width, mode):
+        if by_width:
+            return image.scaledToWidth(length, mode)
+        return image.scaledToHeight(length, mode)
+
+    @staticmethod
+    def scale_hybrid(data, src_width, src_height, bytes_per_line, length, by_width):
+        # 此QImage只在worker线程内部使用，不会跨线程共享
+        source = QImage(data, src_width, src_height, bytes_per_line, PIXEL_FORMAT)
+        fast_scaled = Worker.scale_to(source, length * Config.thumbnail_upscale_factor,
+                                      by_width, Qt.FastTransformation)
+        final_scaled = Worker.scale_to(fast_scaled, length, by_width, Qt.SmoothTransformation)
+        return Worker.image_to_bytes(final_scaled)
+
+    @staticmethod
+    def scale_smooth(data, src_width, src_height, bytes_per_line, length, by_width):
+        source = QImage(data, src_width, src_height, bytes_per_line, PIXEL_FORMAT)
+        final_scaled = Worker.scale_to(source, length, by_width, Qt.SmoothTransformation)
+        return Worker.image_to_bytes(final_scaled)
+
+    @staticmethod
+    def resize_area(data, src_width, src_height, bytes_per_line, width, height):
+        arr = np.frombuffer(data, np.uint8).reshape(src_height, bytes_per_line // 4, 4)[:, :src_width]
+        # 预乘alpha的数据可以直接做区域平均，无需关心通道顺序
+        out = cv2.resize(arr, (width, height), interpolation=cv2.INTER_AREA)
+        return out.tobytes(), width, height
+
+    @staticmethod
+    def resize_lanczos(data, src_width, src_height, bytes_per_line, width, height):
+        # 以预乘模式"RGBa"读取，PIL会直接重采样而不再做alpha预乘转换
+        source = Image.frombuffer('RGBa', (src_width, src_height), data, 'raw', 'RGBa', bytes_per_line, 1)
+        return source.resize((width, height), Image.LANCZOS).tobytes(), width, height
 
 
 class Canvasviewer(DockWidget):
-    # 添加类变量用于线程管理
-    _is_thread_running = False
-    _current_thread = None
-    _current_worker = None
+    # 向后台worker提交缩放任务（像素数据, 宽度, 高度, 每行字节数, 目标物理宽度, 目标物理高度, 是否以宽度为基准）
+    request_job = pyqtSignal(bytes, int, int, int, int, int, bool)
+    # 左、右、中键任一按下都视为正在操作画布
+    _MOUSE_MASK = Qt.LeftButton | Qt.RightButton | Qt.MiddleButton
+    # 缩略图标签样式模板，边距启动后不再变化，只需填入背景色
+    _STYLE_TEMPLATE = "background-color: %s; padding: {m}px;".format(m=Config.margin)
+    # 事件过滤器关心的指针事件类型
+    _PRESS_EVENTS = frozenset((QEvent.MouseButtonPress, QEvent.MouseButtonDblClick, QEvent.TabletPress))
+    _RELEASE_EVENTS = frozenset((QEvent.MouseButtonRelease, QEvent.TabletRelease))
+    _MOVE_EVENTS = frozenset((QEvent.MouseMove, QEvent.TabletMove))
     
     def __init__(self):
         super().__init__()
         self.setWindowTitle(Config.get_docker_name())
-        # 缓存当前缩略图数据
-        self._current_thumbnail = None
+        # 缓存应用实例，避免频繁调用instance()
+        self._app = QApplication.instance()
+        self._krita = Krita.instance()
+        # 上一次提交缩放的投影及其目标尺寸，用于判断画布是否有变化
+        self._proj_cache = None
+        self._proj_cache_key = None
         # 初始化状态检测相关变量
-        self.state = 0  # 0: 正常状态, 1: 等待释放
         self.idle_state = False  # 空闲状态
+        self._pressed = False  # 是否正在按住鼠标/笔（笔画进行中）
+        self._pointer_moved = False  # 上次检查释放后按住的指针是否还有移动
+        self._paused = True  # 面板不可见时暂停刷新，首次显示时开始
+        # 安装了指针事件过滤器的主窗口（QWindow）
+        self._filtered_window = None
+        # 上一次画布切换时的文档签名，用于跳过无变化的刷新
+        self._last_sig = None
         
         # 初始化定时器
-        self._timer = QTimer()
-        self._timer.timeout.connect(self.check_state)
-        self._timer.start(Config.state_check_interval)  # 状态检查定时器
+        # 按住期间定期检查释放事件是否被其他窗口（如弹出菜单）接收而漏掉
+        self._release_watchdog = QTimer()
+        self._release_watchdog.timeout.connect(self.check_release)
         
         self.idle_timer = QTimer()
         self.idle_timer.timeout.connect(self.enter_idle_state)
@@ -123,23 +192,50 @@ class Canvasviewer(DockWidget):
         self.idle_signal_timer = QTimer()
         self.idle_signal_timer.timeout.connect(self.send_idle_signal)
         
-        # 监听主题变化
-        app = QApplication.instance()
-        app.paletteChanged.connect(self.update_theme_color)
+        # 刷新请求合并定时器：短时间内的多次刷新请求只执行最后一次
+        self._pending_refresh = QTimer()
+        self._pending_refresh.setSingleShot(True)
+        self._pending_refresh.timeout.connect(self._do_refresh)
+        # 线程运行期间是否有新的刷新请求
+        self._refresh_requested = False
+        
+        # 常驻的后台线程和worker，所有缩放任务通过队列信号投递
+        self._job_running = False
+        self._job_dpi_scale = 1.0
+        self._worker_thread = QThread()
+        self._worker_thread.setObjectName("ThumbnailWorkerThread")
+        self._worker = Worker()
+        self._worker.moveToThread(self._worker_thread)
+        self.request_job.connect(self._worker.do_job, Qt.QueuedConnection)
+        self._worker.finished.connect(self.on_worker_finished)
+        self._worker_thread.start(QThread.LowPriority)  # 使用低优先级
+        
+        # 监听主题变化，切换主题时paletteChanged可能连续触发多次，合并为一次更新
+        self._theme_timer = QTimer()
+        self._theme_timer.setSingleShot(True)
+        self._theme_timer.timeout.connect(self.update_theme_color)
+        self._app.paletteChanged.connect(self.on_palette_changed)
+        # 退出时结束后台线程
+        self._app.aboutToQuit.connect(self.stop_worker_thread)
+        # 面板被销毁时断开应用级连接并结束线程；
+        # 应用和线程对象直接绑定到回调中，不通过正在销毁的面板属性访问
+        self.destroyed.connect(partial(Canvasviewer.release_app_resources, self._app, self._worker_thread,
+                                       self.on_palette_changed, self.stop_worker_thread))
+        
+        # 面板被折叠或切换到其他标签页时暂停刷新
+        self.visibilityChanged.connect(self.on_visibility_changed)
         
         self.initUI()
         print("CanvasViewer 已初始化")
 
+    def on_palette_changed(self, palette):
+        self._theme_timer.start(0)
+
     def update_theme_color(self):
-        # 获取当前应用的调色板
-        app = QApplication.instance()
         # 获取当前主题的Window角色颜色作为倒数第二深的颜色
-        window_color = app.palette().color(QPalette.Window)
+        window_color = self._app.palette().color(QPalette.Window)
         # 更新缩略图标签的背景色
-        margin = Config.margin
-        self.thumbnail_label.setStyleSheet(
-            f"background-color: {window_color.name()}; padding: {margin}px;"
-        )
+        self.thumbnail_label.setStyleSheet(self._STYLE_TEMPLATE % window_color.name())
 
     def initUI(self):
         # 创建主布局
@@ -177,9 +273,9 @@ class Canvasviewer(DockWidget):
         # 获取DPI缩放因子
         dpi_scale = self.devicePixelRatioF() if Config.ENABLE_DPI_CORRECTION else 1.0
         
-        doc = Krita.instance().activeDocument()
+        doc = self._krita.activeDocument()
         if not doc:
-            return int(min(available_width/dpi_scale)), int(min(available_height/dpi_scale))
+            return int(available_width / dpi_scale), int(available_height / dpi_scale), True
 
         # 使用物理像素计算
         canvas_width = doc.width() * dpi_scale
@@ -189,7 +285,8 @@ class Canvasviewer(DockWidget):
         canvas_ratio = doc.width() / doc.height()
         label_ratio = label_size.width() / label_size.height()
         
-        if canvas_ratio > label_ratio:
+        by_width = canvas_ratio > label_ratio
+        if by_width:
             # 画布更宽，以label宽度为基准
             width = label_size.width() * dpi_scale
             height = int(width / canvas_ratio)
@@ -198,146 +295,174 @@ class Canvasviewer(DockWidget):
             height = label_size.height() * dpi_scale
             width = int(height * canvas_ratio)
         
-        # 返回逻辑像素尺寸
-        return int(width / dpi_scale), int(height / dpi_scale)
+        # 返回逻辑像素尺寸，以及缩放时是否以宽度为基准
+        return int(width / dpi_scale), int(height / dpi_scale), by_width
 
     def refresh_thumbnail(self):
-        doc = Krita.instance().activeDocument()
+        # 面板不可见时不刷新，重新显示时会自动刷新
+        if not self.isVisible():
+            return
+        # 合并短时间内的多次刷新请求
+        self._pending_refresh.start(Config.refresh_debounce_interval)
+
+    def _do_refresh(self):
+        doc = self._krita.activeDocument()
         if not doc:
             self.thumbnail_label.setText('没有打开的文档')
+            # 标签已不再显示缩略图，下次打开文档时必须重新缩放
+            self._proj_cache = None
+            self._proj_cache_key = None
             return
             
-        # 如果已有线程在运行，尝试先停止它
-        if Canvasviewer._is_thread_running:
-            try:
-                # 安全地停止当前线程
-                if Canvasviewer._current_thread and Canvasviewer._current_thread.isRunning():
-                    Canvasviewer._current_thread.quit()
-                    # 给线程一点时间退出，但不阻塞UI
-                    if not Canvasviewer._current_thread.wait(100):
-                        print("警告: 线程未能及时退出")
-                        # 重置线程状态但不强制终止
-                        Canvasviewer._is_thread_running = False
-                        return
-            except Exception as e:
-                print(f"停止线程错误: {str(e)}")
-                # 重置线程状态
-                Canvasviewer._is_thread_running = False
-                return
+        # 如果已有线程在运行，记录请求，待当前线程结束后再刷新
+        if self._job_running:
+            self._refresh_requested = True
+            return
             
         # 获取DPI缩放因子
         dpi_scale = self.devicePixelRatioF() if Config.ENABLE_DPI_CORRECTION else 1.0
         
-        # 使用物理像素捕获投影
-        projection = doc.projection(0, 0, doc.width(), doc.height())
-        projection.setDevicePixelRatio(dpi_scale)
+        # 获取目标尺寸，物理像素尺寸 = 逻辑尺寸 * DPI 缩放因子
+        thumb_width, thumb_height, by_width = self.get_thumbnail_size()
+        physical_width = int(thumb_width * dpi_scale)
+        physical_height = int(thumb_height * dpi_scale)
         
-        # 获取目标尺寸
-        thumb_width, thumb_height = self.get_thumbnail_size()
+        # 向Krita请求缩小后的缩略图，多请求数倍尺寸留给worker做最后的高质量缩小，但不超过画布本身尺寸。
+        # Krita内部仍会读取完整投影并自行缩放，这里省去的是完整分辨率图像的格式转换、
+        # 像素数据拷贝以及后续的比较和线程间传递
+        request_width = max(1, min(doc.width(), physical_width * Config.thumbnail_upscale_factor))
+        request_height = max(1, min(doc.height(), physical_height * Config.thumbnail_upscale_factor))
         
-        try:
-            # 创建worker和thread
-            Canvasviewer._current_worker = Worker(projection, thumb_width, thumb_height)
-            Canvasviewer._current_thread = QThread()
-            Canvasviewer._current_worker.moveToThread(Canvasviewer._current_thread)
-            
-            # 连接信号和槽
-            Canvasviewer._current_thread.started.connect(Canvasviewer._current_worker.process)
-            Canvasviewer._current_worker.finished.connect(self.on_worker_finished)
-            
-            # 设置线程运行标志
-            Canvasviewer._is_thread_running = True
-            
-            # 确保线程在Krita主事件循环中运行
-            Canvasviewer._current_thread.setObjectName("ThumbnailWorkerThread")
-            Canvasviewer._current_thread.start(QThread.LowPriority)  # 使用低优先级
-        except Exception as e:
-            print(f"创建线程错误: {str(e)}")
-            # 重置线程状态
-            Canvasviewer._is_thread_running = False
-
-    def on_worker_finished(self, image):
-        # 更新缩略图
-        self.update_thumbnail(image)
+        # 在GUI线程提取一次像素数据
+        projection = doc.thumbnail(request_width, request_height)
+        projection = projection.convertToFormat(PIXEL_FORMAT)
+        job = (projection.constBits().asstring(projection.sizeInBytes()),
+               projection.width(), projection.height(), projection.bytesPerLine())
         
-        # 清理线程资源
-        try:
-            if Canvasviewer._current_thread and Canvasviewer._current_worker:
-                # 断开所有连接，使用try-except防止断开不存在的连接
-                try:
-                    if Canvasviewer._current_thread.started.receivers() > 0:
-                        Canvasviewer._current_thread.started.disconnect()
-                except Exception as e:
-                    print(f"断开线程started信号错误: {str(e)}")
-                    
-                try:
-                    if Canvasviewer._current_worker.finished.receivers() > 0:
-                        Canvasviewer._current_worker.finished.disconnect()
-                except Exception as e:
-                    print(f"断开worker finished信号错误: {str(e)}")
-                
-                # 结束线程，添加超时处理
-                Canvasviewer._current_thread.quit()
-                # 等待最多200毫秒
-                if not Canvasviewer._current_thread.wait(200):
-                    print("警告: 线程未能在超时时间内结束")
-                
-                # 删除对象
-                Canvasviewer._current_worker.deleteLater()
-                Canvasviewer._current_thread.deleteLater()
-        except Exception as e:
-            print(f"清理线程资源错误: {str(e)}")
-            # 在异常情况下显示错误信息
-            self.thumbnail_label.setText('没有打开的文档')
-        finally:
-            # 无论如何都重置引用和标志，确保下一次可以创建新线程
-            Canvasviewer._current_worker = None
-            Canvasviewer._current_thread = None
-            Canvasviewer._is_thread_running = False
+        # Krita没有可用的内容变化通知（撤销、菜单滤镜、图层面板操作都不经过画布点击），
+        # 因此仍需获取投影，但投影和目标尺寸都与上次相同时跳过缩放
+        cache_key = (thumb_width, thumb_height, dpi_scale, by_width)
+        if (self._proj_cache is not None and cache_key == self._proj_cache_key
+                and job == self._proj_cache):
+            # 空闲时画布持续无变化，逐次加倍空闲刷新间隔以减少获取投影的次数
+            if self.idle_state:
+                self.idle_signal_timer.setInterval(
+                    min(self.idle_signal_timer.interval() * 2, Config.idle_refresh_max_interval))
+            return
+        self._proj_cache = job
+        self._proj_cache_key = cache_key
+        # 画布有变化，恢复正常的空闲刷新间隔
+        self.idle_signal_timer.setInterval(Config.idle_refresh_interval)
+        
+        # 投递任务到后台线程
+        self._job_running = True
+        self._job_dpi_scale = dpi_scale
+        self.request_job.emit(*job, physical_width, physical_height, by_width)
+
+    def on_worker_finished(self, data, width, height, bytes_per_line):
+        # 在GUI线程中由像素数据构造QImage，并一次性转换为QPixmap（转换时会拷贝数据）
+        if data:
+            image = QImage(data, width, height, bytes_per_line, PIXEL_FORMAT)
+            pixmap = QPixmap.fromImage(image)
+            # 设置物理像素信息
+            pixmap.setDevicePixelRatio(self._job_dpi_scale)
+            self.update_thumbnail(pixmap)
+        else:
+            # 缩放失败时清除缓存以便下次重试
+            self._proj_cache = None
+        self._job_running = False
+
+        # 线程运行期间有新的刷新请求，立即补做一次
+        if self._refresh_requested or self._pending_refresh.isActive():
+            self._refresh_requested = False
+            self._pending_refresh.stop()
+            self._do_refresh()
+
+    def stop_worker_thread(self):
+        self._worker_thread.quit()
+        self._worker_thread.wait()
 
-    def update_thumbnail(self, image):
+    @staticmethod
+    def release_app_resources(app, worker_thread, palette_slot, quit_slot, *_):
+        for signal, slot in ((app.paletteChanged, palette_slot), (app.aboutToQuit, quit_slot)):
+            try:
+                signal.disconnect(slot)
+            except TypeError:
+                pass
+        worker_thread.quit()
+        worker_thread.wait()
+
+    def update_thumbnail(self, pixmap):
         try:
-            if not image.isNull():
-                # 将QImage转换为QPixmap并显示
-                pixmap = QPixmap.fromImage(image)
+            if not pixmap.isNull():
+                # 直接显示已转换好的QPixmap
                 self.thumbnail_label.setPixmap(pixmap)
-                self._current_thumbnail = image
         except Exception as e:
             print(f"Update thumbnail error: {str(e)}")
 
-    def update_thumbnail_display(self):
-        if not self._current_thumbnail:
+    def eventFilter(self, obj, event):
+        if obj is self._filtered_window:
+            # 过滤器位于所有控件（包括画布的KisInputManager）之前，只观察事件而不拦截
+            event_type = event.type()
+            if event_type in Canvasviewer._MOVE_EVENTS:
+                if self._pressed:
+                    self._pointer_moved = True
+            elif event_type in Canvasviewer._PRESS_EVENTS:
+                self.on_pointer_pressed()
+            elif event_type in Canvasviewer._RELEASE_EVENTS:
+                # 松开其中一个键但仍有其他键按住时不算结束
+                if not event.buttons() & Canvasviewer._MOUSE_MASK:
+                    self.on_pointer_released()
+            return False
+        return super().eventFilter(obj, event)
+
+    def on_pointer_pressed(self):
+        # 开始操作画布，取消空闲状态
+        self._pressed = True
+        self._pointer_moved = False
+        self.idle_state = False
+        self.idle_timer.stop()
+        self._release_watchdog.start(Config.release_check_interval)
+
+    def on_pointer_released(self):
+        # 操作结束，不在空闲状态时刷新（线程运行中的请求会被合并到结束后执行）
+        self._pressed = False
+        self._release_watchdog.stop()
+        if not self.idle_state:
+            self.refresh_thumbnail()
+        self.idle_timer.start(Config.idle_check_interval)
+
+    def check_release(self):
+        # 上次检查后指针仍在移动，说明笔画还在进行
+        if self._pointer_moved:
+            self._pointer_moved = False
             return
-            
-        # 获取当前需要的显示尺寸
-        thumb_width, thumb_height = self.get_thumbnail_size()
-        
-        # 缩放图像并显示
-        scaled_image = self._current_thumbnail.scaled(thumb_width, thumb_height, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-        pixmap = QPixmap.fromImage(scaled_image)
-        self.thumbnail_label.setPixmap(pixmap)
-
-    def check_state(self):
-        # 检测鼠标状态
-        mouse_buttons = QApplication.mouseButtons()
-        is_left_pressed = bool(mouse_buttons & Qt.LeftButton)
-        is_right_pressed = bool(mouse_buttons & Qt.RightButton)
-        is_middle_pressed = bool(mouse_buttons & Qt.MiddleButton)
-
-        # 更新状态机
-        if self.state == 0:
-            if not is_left_pressed and not is_right_pressed and not is_middle_pressed:
-                self.state = 1
-                # 只有在没有线程运行且不在空闲状态时才刷新
-                if not Canvasviewer._is_thread_running and not self.idle_state:
-                    self.refresh_thumbnail()
-                self.idle_timer.start(Config.idle_check_interval)
-        elif self.state == 1:
-            if is_left_pressed or is_right_pressed or is_middle_pressed:
-                self.state = 0
-                if self.idle_state:
-                    self.idle_state = False
-                self.idle_timer.stop()
+        # 指针静止且没有按键按下时视为已释放。笔输入的按键不一定反映在mouseButtons()中，
+        # 此时最多提前一次进入释放流程，多刷新几次，但不会一直停在按住状态
+        if not QApplication.mouseButtons() & Canvasviewer._MOUSE_MASK:
+            self.on_pointer_released()
+
+    def install_pointer_filter(self):
+        # 过滤器安装在面板所在主窗口的QWindow上：该窗口的所有鼠标和数位板事件
+        # 都先经过它再分发给画布等子控件。面板浮动时parentWidget()仍是主窗口
+        parent = self.parentWidget()
+        window = (parent.window() if parent else self.window()).windowHandle()
+        if window is self._filtered_window:
+            return
+        self.remove_pointer_filter()
+        if window is not None:
+            window.installEventFilter(self)
+            self._filtered_window = window
+
+    def remove_pointer_filter(self):
+        if self._filtered_window is None:
+            return
+        try:
+            self._filtered_window.removeEventFilter(self)
+        except RuntimeError:
+            # 窗口已被销毁，过滤器也随之失效
+            pass
+        self._filtered_window = None
 
     def enter_idle_state(self):
         if not self.idle_state:
@@ -347,12 +472,59 @@ class Canvasviewer(DockWidget):
     def send_idle_signal(self):
         if self.idle_state:
             # 只有在没有线程运行时才刷新
-            if not Canvasviewer._is_thread_running:
+            if not self._job_running:
                 self.refresh_thumbnail()
         else:
             self.idle_signal_timer.stop()
 
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.resume_refresh()
+
+    def hideEvent(self, event):
+        super().hideEvent(event)
+        self.pause_refresh()
+
+    def on_visibility_changed(self, visible):
+        if visible:
+            self.resume_refresh()
+        else:
+            self.pause_refresh()
+
+    def resume_refresh(self):
+        if not self._paused:
+            return
+        self._paused = False
+        self.install_pointer_filter()
+        # 隐藏期间画布可能已变化，重置状态并立即刷新
+        self.idle_state = False
+        self.on_pointer_released()
+
+    def pause_refresh(self):
+        # 移除事件过滤器，停止所有定时器并取消尚未执行的刷新请求
+        self._paused = True
+        self.remove_pointer_filter()
+        self._pressed = False
+        self._release_watchdog.stop()
+        self.idle_timer.stop()
+        self.idle_signal_timer.stop()
+        self._pending_refresh.stop()
+        self._refresh_requested = False
+
     def canvasChanged(self, canvas):
+        if self._paused:
+            return
+        # 面板可能已被移到其他主窗口，重新安装过滤器（窗口未变时不做任何事）
+        self.install_pointer_filter()
+        
+        # 平移视图、切换工具等也会触发canvasChanged，仍是同一文档且尺寸未变时不刷新；
+        # 内容变化由笔画结束和空闲刷新重新获取缩略图后比较像素数据来发现
+        doc = self._krita.activeDocument()
+        sig = (doc, doc.width(), doc.height()) if doc else None
+        if sig is not None and sig == self._last_sig:
+            return
+        self._last_sig = sig
+        
         # 画布改变时刷新缩略图
         self.refresh_thumbnail()
 